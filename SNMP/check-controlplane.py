@@ -5,8 +5,15 @@ Audit Junos devices for presence of the substring:
 anywhere within:
   show configuration firewall family inet | display set | no-more
 
+The device-side '| match' pipe narrows the output to candidate lines before
+it is sent back, so large firewall configs are not transferred in full. The
+command runs on a single SSH exec channel: no interactive shell, pager or
+prompt matching is involved. Sessions are driven by asyncssh on one asyncio
+event loop, so concurrency costs no thread per device.
+
 Outputs:
 - CSV summary (--out): host, reachable, found, matches, error
+  (reachable=True with an error means the device rejected the audit command)
 - TXT file listing devices that matched (default: <csvbase>_have.txt)
 - TXT file listing devices that did not match (default: <csvbase>_missing.txt)
 
@@ -14,90 +21,300 @@ Run:
   python3 audit_cp_snmp_term.py --devices devices.txt --out report.csv --workers 30
   # optional:
   # --have-file matched.txt --missing-file missing.txt
+  # --resume report.csv          (skip hosts that were reachable in a previous report)
+  # --ssh-config ~/.ssh/config   (loaded by asyncssh: Hostname/Port/ProxyJump/...)
+  # --jump-host bastion          (tunnel every device session through one bastion connection)
+  # --jump-user ops              (bastion login; keys/agent tried before any password)
+  # --system-ssh                 (use OpenSSH with connection sharing; key/agent auth)
+
+Connection sharing:
+  With --jump-host, one SSH connection to the bastion is opened and every
+  device session is carried as a channel over it, so the bastion sees a
+  single TCP connection and a single login. Device sessions themselves still
+  perform their own SSH handshake.
+
+  With --system-ssh the audit command is run through the OpenSSH client with
+  ControlMaster=auto / ControlPersist=60, so re-runs within 60s reuse the
+  master connection over a Unix socket. The equivalent ~/.ssh/config entry:
+
+    Host *
+      ControlMaster auto
+      ControlPath ~/.ssh/cm-%r@%h:%p
+      ControlPersist 60s
+
+  OpenSSH runs in BatchMode, so no password is prompted for in this mode.
+
+Concurrency:
+  Each SSH session holds several file descriptors (socket, channel, pipes),
+  so --workers is capped at (RLIMIT_NOFILE soft limit - 64) // 8. Raise
+  'ulimit -n' rather than --workers if the cap is hit.
+  Independently, at most --per-subnet sessions (default 4) run against any
+  one /24 (IPv6: /64) at a time, so a burst of connects to one management
+  subnet does not trip device rate limits or spike mgd CPU. Hosts given by
+  name are not grouped.
 """
 
 from __future__ import annotations
 import argparse
+import asyncio
 import csv
 import getpass
+import ipaddress
+import re
 import sys
-from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-from typing import Dict, Tuple, List
+from typing import Callable, Dict, Tuple, List
+
+import asyncssh
 
-from netmiko import ConnectHandler
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
 
 TARGET_SUBSTR = "set firewall family inet filter controlplane-filter term snmp_allow_in"
+# Further terms can be appended; all are counted in one pass over the output
+# (AUDIT_CMD's '| match' pattern must still cover every term).
+TARGETS = (TARGET_SUBSTR,)
+# Any run of whitespace between tokens matches, so the raw output needs no canonicalizing.
+TARGET_RE = re.compile("|".join(r"\s+".join(map(re.escape, t.split())) for t in TARGETS))
+# Filter on the device so only candidate lines cross the SSH channel.
+AUDIT_CMD = (
+    "show configuration firewall family inet | display set"
+    ' | match "controlplane-filter term snmp_allow_in" | no-more'
+)
+CSV_HEADER = ["host", "reachable", "found", "matches", "error"]
+CSV_BUFFER = 1 << 20  # report is flushed when the buffer fills and on close (incl. Ctrl-C/errors)
+Result = Tuple[str, bool, bool, int, str]
+FD_RESERVE = 64       # descriptors kept back for stdio, reports and the interpreter
+FDS_PER_SESSION = 8   # descriptors budgeted per concurrent SSH session
+# ControlPath lives in ~/.ssh; main() creates it (0700) before a --system-ssh run
+SSH_MUX_OPTS = [
+    "-o", "ControlMaster=auto",
+    "-o", "ControlPath=~/.ssh/cm-%r@%h:%p",
+    "-o", "ControlPersist=60",
+]
 
 def load_devices(path: Path) -> List[str]:
     if not path.exists():
         raise FileNotFoundError(f"{path} not found")
     hosts: List[str] = []
-    for raw in path.read_text(encoding="utf-8").splitlines():
+    seen = set()
+    # Hosts/IPs are ASCII: split the raw bytes and decode only the host token
+    data = path.read_bytes()
+    if data.startswith(b"\xef\xbb\xbf"):  # UTF-8 BOM, e.g. saved by Notepad
+        data = data[3:]
+    for lineno, raw in enumerate(data.splitlines(), 1):
         line = raw.strip()
-        if not line or line.startswith("#"):
+        if not line or line[:1] == b"#":
             continue
-        hosts.append(line.split(",")[0].strip())
+        try:
+            host = line.split(b",", 1)[0].strip().decode("ascii")
+        except UnicodeDecodeError:
+            print(f"{path}:{lineno}: skipping non-ASCII host entry", file=sys.stderr)
+            continue
+        if host in seen:
+            continue
+        seen.add(host)
+        hosts.append(host)
     if not hosts:
         raise ValueError(f"No hosts found in {path}")
     return hosts
 
-def canonicalize(s: str) -> str:
-    return " ".join(s.split())
+def load_resume(path: Path) -> List[Dict[str, str]]:
+    """
+    Rows of a previous report audited cleanly (reachable, no error); those hosts are not re-audited.
+    """
+    if not path.exists():
+        raise FileNotFoundError(f"{path} not found")
+    with path.open(newline="", encoding="utf-8") as f:
+        return [row for row in csv.DictReader(f) if row.get("reachable") == "True" and not row.get("error")]
+
+class CommandError(RuntimeError):
+    """
+    The device answered over SSH but rejected or failed the audit command.
+    """
 
-def check_host(host: str, username: str, password: str, timeouts: Dict[str, int]) -> Tuple[str, bool, bool, int, str]:
+def cap_workers(requested: int) -> int:
     """
-    Returns: (host, reachable, found, matches, error)
+    Clamp the worker count to what the RLIMIT_NOFILE soft limit can sustain.
+    """
+    requested = max(1, requested)
+    if resource is None:
+        return requested
+    soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY:
+        return requested
+    return max(1, min(requested, (soft - FD_RESERVE) // FDS_PER_SESSION))
+
+def subnet_key(host: str) -> str:
+    """
+    Management subnet used to group a host: its /24 (IPv6: /64), or the name itself.
     """
-    conn = None
     try:
-        conn = ConnectHandler(
-            device_type="juniper",
-            host=host,
-            username=username,
-            password=password,
-            fast_cli=False,
-            global_delay_factor=1,
-            timeout=timeouts["timeout"],
-            auth_timeout=timeouts["auth_timeout"],
-            banner_timeout=timeouts["banner_timeout"],
-            conn_timeout=timeouts["conn_timeout"],
-        )
-
-        # Disable pager (harmless if already off)
-        try:
-            conn.send_command("set cli screen-length 0")
-        except Exception:
-            pass
+        ip = ipaddress.ip_address(host)
+    except ValueError:
+        return host
+    prefix = 24 if ip.version == 4 else 64
+    return str(ipaddress.ip_network(f"{ip}/{prefix}", strict=False))
 
-        cmd = "show configuration firewall family inet | display set | no-more"
-        out = conn.send_command(cmd)
+def ssh_options(
+    username: str,
+    password: str,
+    timeouts: Dict[str, int],
+    ssh_config: str | None = None,
+) -> Dict[str, object]:
+    """
+    asyncssh.connect() keyword arguments: password auth only, host keys not checked.
+    """
+    return dict(
+        username=username,
+        password=password,
+        known_hosts=None,
+        client_keys=None,
+        agent_path=None,
+        config=[ssh_config] if ssh_config else None,
+        connect_timeout=timeouts["conn_timeout"],
+        login_timeout=max(timeouts["auth_timeout"], timeouts["banner_timeout"]),
+    )
 
-        target = canonicalize(TARGET_SUBSTR)
-        matches = 0
-        for line in out.splitlines():
-            if target in canonicalize(line):
-                matches += 1
+def jump_options(
+    username: str,
+    password: str | None,
+    timeouts: Dict[str, int],
+    ssh_config: str | None = None,
+) -> Dict[str, object]:
+    """
+    asyncssh.connect() keyword arguments for the bastion: default keys and agent, then password.
+    """
+    return dict(
+        username=username,
+        password=password or None,
+        known_hosts=None,
+        config=[ssh_config] if ssh_config else None,
+        connect_timeout=timeouts["conn_timeout"],
+        login_timeout=max(timeouts["auth_timeout"], timeouts["banner_timeout"]),
+    )
 
-        found = matches > 0
-        return (host, True, found, matches, "")
+async def run_system_ssh(
+    host: str,
+    username: str,
+    timeouts: Dict[str, int],
+    ssh_config: str | None = None,
+) -> str:
+    """
+    Run AUDIT_CMD through the OpenSSH client, sharing a ControlMaster socket.
+    """
+    cmd = [
+        "ssh",
+        "-o", "BatchMode=yes",
+        "-o", f"ConnectTimeout={timeouts['conn_timeout']}",
+        *SSH_MUX_OPTS,
+        *(["-F", ssh_config] if ssh_config else []),
+        "-l", username,
+        host,
+        AUDIT_CMD,
+    ]
+    proc = await asyncio.create_subprocess_exec(
+        *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        out, err = await asyncio.wait_for(proc.communicate(), timeouts["timeout"])
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+        raise
+    if proc.returncode != 0:
+        msg = err.decode(errors="replace").strip() or f"ssh exited with status {proc.returncode}"
+        # OpenSSH reserves 255 for its own (connection/auth) failures; anything else is the remote command
+        raise (RuntimeError if proc.returncode == 255 else CommandError)(msg)
+    return out.decode("utf-8", errors="replace")
 
-    except Exception as e:
-        return (host, False, False, 0, str(e))
-    finally:
+async def run_asyncssh(
+    host: str,
+    options: Dict[str, object],
+    timeouts: Dict[str, int],
+    tunnel: asyncssh.SSHClientConnection | None = None,
+) -> str:
+    """
+    Run AUDIT_CMD on one exec channel and return its output once the device closes it.
+    """
+    # Only pass tunnel= when set: an explicit None would disable ProxyJump from --ssh-config
+    async with asyncssh.connect(host, **options, **({"tunnel": tunnel} if tunnel else {})) as conn:
+        result = await asyncio.wait_for(conn.run(AUDIT_CMD, check=False), timeouts["timeout"])
+    err = result.stderr or ""
+    err = err if isinstance(err, str) else err.decode("utf-8", errors="replace")
+    # Empty stdout means "missing" only if the device actually ran the command
+    if result.exit_status not in (0, None) or err.strip():
+        raise CommandError(err.strip() or f"command exited with status {result.exit_status}")
+    out = result.stdout or ""
+    return out if isinstance(out, str) else out.decode("utf-8", errors="replace")
+
+async def check_host(
+    host: str,
+    sem: asyncio.Semaphore,
+    subnet_sem: asyncio.Semaphore,
+    options: Dict[str, object],
+    timeouts: Dict[str, int],
+    system_ssh: bool = False,
+    tunnel: asyncssh.SSHClientConnection | None = None,
+    ssh_config: str | None = None,
+) -> Result:
+    """
+    Returns: (host, reachable, found, matches, error)
+    """
+    # Wait for the subnet slot first so queued hosts don't hold a global slot
+    async with subnet_sem, sem:
         try:
-            if conn:
-                conn.disconnect()
-        except Exception:
-            pass
-
-def write_csv(rows: List[Tuple[str, bool, bool, int, str]], out_path: Path) -> None:
-    out_path.parent.mkdir(parents=True, exist_ok=True)
-    with out_path.open("w", newline="", encoding="utf-8") as f:
-        w = csv.writer(f)
-        w.writerow(["host", "reachable", "found", "matches", "error"])
-        for r in rows:
-            w.writerow(r)
+            if system_ssh:
+                out = await run_system_ssh(host, str(options["username"]), timeouts, ssh_config)
+            else:
+                out = await run_asyncssh(host, options, timeouts, tunnel)
+
+            # Each 'set' line holds a term at most once, so this is the matching line count.
+            matches = len(TARGET_RE.findall(out))
+
+            found = matches > 0
+            return (host, True, found, matches, "")
+
+        except CommandError as e:
+            return (host, True, False, 0, str(e))
+        except Exception as e:
+            return (host, False, False, 0, str(e) or type(e).__name__)
+
+async def run_audit(
+    hosts: List[str],
+    workers: int,
+    options: Dict[str, object],
+    timeouts: Dict[str, int],
+    on_result: Callable[[Result], None],
+    per_subnet: int = 4,
+    system_ssh: bool = False,
+    tunnel: asyncssh.SSHClientConnection | None = None,
+    ssh_config: str | None = None,
+) -> None:
+    """
+    Audit all hosts with at most `workers` sessions in flight (and `per_subnet`
+    per subnet), reporting each result as it completes.
+    """
+    sem = asyncio.Semaphore(workers)
+    keys = {h: subnet_key(h) for h in hosts}
+    subnet_sems = {k: asyncio.Semaphore(max(1, per_subnet)) for k in set(keys.values())}
+    tasks = [
+        check_host(h, sem, subnet_sems[keys[h]], options, timeouts, system_ssh, tunnel, ssh_config)
+        for h in hosts
+    ]
+    for fut in asyncio.as_completed(tasks):
+        on_result(await fut)
+
+def csv_line(r: Tuple[object, ...]) -> str:
+    """
+    Format one report row. Host, flags and count never need quoting; only the error text can.
+    """
+    host, reach, hit, matches, err = r
+    if err and any(c in err for c in ',"\r\n'):
+        err = '"' + err.replace('"', '""') + '"'
+    return f"{host},{reach},{hit},{matches},{err}\r\n"
 
 def write_list(lines: List[str], path: Path) -> None:
     path.parent.mkdir(parents=True, exist_ok=True)
@@ -116,18 +333,44 @@ def main() -> None:
     ap = argparse.ArgumentParser(description="Audit for presence of controlplane SNMP term substring.")
     ap.add_argument("--devices", required=True, type=Path, help="Path to devices.txt (one host/IP per line)")
     ap.add_argument("--out", required=True, type=Path, help="CSV report output path (e.g., report.csv)")
-    ap.add_argument("--workers", type=int, default=30, help="Concurrent SSH sessions (default 30)")
-    ap.add_argument("--timeout", type=int, default=90, help="SSH overall timeout seconds (default 90)")
+    ap.add_argument("--workers", type=int, default=30, help="Concurrent SSH sessions (default 30, capped by ulimit -n)")
+    ap.add_argument("--per-subnet", type=int, default=4,
+                    help="Concurrent SSH sessions per /24 management subnet (default 4)")
+    ap.add_argument("--timeout", type=int, default=90, help="Command read timeout seconds (default 90)")
     ap.add_argument("--auth-timeout", type=int, default=60, help="Auth timeout seconds (default 60)")
     ap.add_argument("--banner-timeout", type=int, default=60, help="Banner timeout seconds (default 60)")
     ap.add_argument("--conn-timeout", type=int, default=60, help="Connect timeout seconds (default 60)")
     ap.add_argument("--have-file", type=Path, help="TXT path for devices WITH the substring")
     ap.add_argument("--missing-file", type=Path, help="TXT path for devices WITHOUT the substring")
+    ap.add_argument("--ssh-config", type=Path, help="OpenSSH config file to resolve hosts (e.g., ~/.ssh/config); passed as -F with --system-ssh")
+    ap.add_argument("--system-ssh", action="store_true",
+                    help="Run the audit via OpenSSH with ControlMaster connection sharing (key/agent auth)")
+    ap.add_argument("--jump-host",
+                    help="Bastion to tunnel all device sessions through (one shared connection; "
+                         "ignored with --system-ssh, use ProxyJump there)")
+    ap.add_argument("--jump-user",
+                    help="Bastion username (default: device username). Keys/agent are tried first; "
+                         "the device password is offered only when this is not set")
+    ap.add_argument("--resume", type=Path,
+                    help="Previous CSV report; hosts reachable there are carried over, not re-audited")
     args = ap.parse_args()
 
     hosts = load_devices(args.devices)
+    # Read before --out is opened, so resuming into the same file is safe
+    prior = load_resume(args.resume) if args.resume else []
+    if prior:
+        # Carry over one row per host, and only for hosts still in --devices
+        wanted = set(hosts)
+        carried: Dict[str, Dict[str, str]] = {}
+        for row in prior:
+            if row["host"] in wanted:
+                carried.setdefault(row["host"], row)
+        prior = list(carried.values())
+        hosts = [h for h in hosts if h not in carried]
+        print(f"Resuming from {args.resume}: {len(carried)} hosts already audited")
     username = input("Username: ").strip()
-    password = getpass.getpass("Password: ")
+    password = "" if args.system_ssh else getpass.getpass("Password: ")
+    ssh_config = str(args.ssh_config.expanduser()) if args.ssh_config else None
 
     timeouts = {
         "timeout": int(args.timeout),
@@ -136,21 +379,68 @@ def main() -> None:
         "conn_timeout": int(args.conn_timeout),
     }
 
+    workers = cap_workers(args.workers)
+    if workers < args.workers:
+        print(f"Limiting workers to {workers} (open file limit); raise 'ulimit -n' for more.")
+    options = ssh_options(username, password, timeouts, ssh_config)
+    if args.system_ssh:
+        # OpenSSH cannot create the ControlPath socket if ~/.ssh is missing
+        (Path.home() / ".ssh").mkdir(mode=0o700, exist_ok=True)
+
     print(f"Auditing {len(hosts)} devices for substring:\n  '{TARGET_SUBSTR}'")
 
-    results: List[Tuple[str, bool, bool, int, str]] = []
-    with ThreadPoolExecutor(max_workers=max(1, args.workers)) as ex:
-        futs = [ex.submit(check_host, h, username, password, timeouts) for h in hosts]
-        for fut in as_completed(futs):
-            results.append(fut.result())
+    # CSV rows are streamed as results arrive; only host names are kept for the summary
+    found: List[str] = []
+    missing: List[str] = []
+    unreachable: List[str] = []
+    failed: List[str] = []  # reachable, but the audit command was rejected
 
-    # CSV
-    write_csv(results, args.out)
+    async def audit() -> bool:
+        # Reach the bastion before --out is opened, so a failure leaves the old report intact
+        tunnel = None
+        if args.jump_host and not args.system_ssh:
+            jump_pw = None if args.jump_user else password
+            jump = jump_options(args.jump_user or username, jump_pw, timeouts, ssh_config)
+            try:
+                tunnel = await asyncssh.connect(args.jump_host, **jump)
+            except (OSError, asyncssh.Error, asyncio.TimeoutError) as e:
+                print(f"Cannot connect to jump host {args.jump_host}: {str(e) or type(e).__name__}",
+                      file=sys.stderr)
+                return False
+        try:
+            args.out.parent.mkdir(parents=True, exist_ok=True)
+            with args.out.open("w", newline="", encoding="utf-8", buffering=CSV_BUFFER) as f:
+                f.write(",".join(CSV_HEADER) + "\r\n")
+                for row in prior:
+                    f.write(csv_line(tuple(row[c] for c in CSV_HEADER)))
+                    (found if row["found"] == "True" else missing).append(row["host"])
+
+                def record(r: Result) -> None:
+                    f.write(csv_line(r))
+                    host, reach, hit, err = r[0], r[1], r[2], r[4]
+                    if not reach:
+                        unreachable.append(host)
+                    elif err:
+                        failed.append(host)
+                    else:
+                        (found if hit else missing).append(host)
+
+                await run_audit(
+                    hosts, workers, options, timeouts, record, args.per_subnet, args.system_ssh, tunnel, ssh_config
+                )
+        finally:
+            if tunnel:
+                tunnel.close()
+                await tunnel.wait_closed()
+        return True
 
-    # Build lists
-    reachable = [r for r in results if r[1]]
-    found = sorted([r[0] for r in reachable if r[2]])
-    missing = sorted([r[0] for r in reachable if not r[2]])
+    if not asyncio.run(audit()):
+        sys.exit(1)
+
+    found.sort()
+    missing.sort()
+    unreachable.sort()
+    failed.sort()
 
     # TXT paths (defaults derived from CSV path)
     have_path, missing_path = default_txt_paths(args.out, args.have_file, args.missing_file)
@@ -158,25 +448,25 @@ def main() -> None:
     write_list(missing, missing_path)
 
     # Console summary
-    total = len(results)
-    unreachable = [r for r in results if not r[1]]
+    total = len(found) + len(missing) + len(unreachable) + len(failed)
 
     print("\n=== Audit Summary ===")
     print(f"Total devices:  {total}")
-    print(f"Reachable:      {len(reachable)}")
+    print(f"Reachable:      {len(found) + len(missing) + len(failed)}")
     print(f"Unreachable:    {len(unreachable)}")
+    print(f"Command failed: {len(failed)}  (see error column in {args.out})")
     print(f"Found:          {len(found)}  (listed in: {have_path})")
     print(f"Missing:        {len(missing)} (listed in: {missing_path})")
 
+    # One write per block rather than one print per host
     if missing:
-        print("\nDevices missing substring:")
-        for h in missing:
-            print(f"  - {h}")
+        sys.stdout.write("\nDevices missing substring:\n" + "".join(f"  - {h}\n" for h in missing))
 
     if unreachable:
-        print("\nUnreachable devices:")
-        for host, *_ in sorted([(r[0],) for r in unreachable]):
-            print(f"  - {host}")
+        sys.stdout.write("\nUnreachable devices:\n" + "".join(f"  - {h}\n" for h in unreachable))
+
+    if failed:
+        sys.stdout.write("\nDevices that rejected the audit command:\n" + "".join(f"  - {h}\n" for h in failed))
 
     print(f"\nCSV saved to: {args.out}")
 
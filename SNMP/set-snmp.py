@@ -1,15 +1,26 @@
 #!/usr/bin/env python3
-import getpass, threading
+import getpass, sys, threading
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
+import paramiko
 from netmiko import ConnectHandler
 
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
 # --- Fixed settings (edit if needed) ---
 DEVICES_FILE = "devices.txt"
 WORKERS = 20
 CMD1 = "set firewall family inet filter controlplane-filter term snmp_allow_in from source-address 10.0.0.0/24"
 CMD2 = "set firewall family inet filter controlplane-filter term snmp_allow_in from source-address 10.1.0.0/24"
+SHOW_CMD = ('show configuration firewall family inet | display set'
+            ' | match "controlplane-filter term snmp_allow_in" | no-more')
+NEED_SET = frozenset([" ".join(CMD1.split()), " ".join(CMD2.split())])
 TIMEOUTS = dict(timeout=120, auth_timeout=90, banner_timeout=90, conn_timeout=90)
+FD_RESERVE = 64       # descriptors kept back for stdio and the interpreter
+FDS_PER_SESSION = 8   # descriptors budgeted per concurrent SSH session
 # ---------------------------------------
 
 print_lock = threading.Lock()
@@ -17,53 +28,96 @@ def log(host, msg):
     with print_lock:
         print(f"[{host}] {msg}", flush=True)
 
+def cap_workers(requested: int) -> int:
+    # each SSH session holds several fds; keep (nofile - FD_RESERVE) // FDS_PER_SESSION at most
+    requested = max(1, requested)
+    if resource is None:
+        return requested
+    soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY:
+        return requested
+    return max(1, min(requested, (soft - FD_RESERVE) // FDS_PER_SESSION))
+
 def load_hosts(path: str) -> list[str]:
     p = Path(path)
     if not p.exists():
         raise FileNotFoundError(f"{path} not found")
     hosts: list[str] = []
-    for line in p.read_text().splitlines():
+    seen = set()
+    data = p.read_bytes()
+    if data.startswith(b"\xef\xbb\xbf"):  # UTF-8 BOM, e.g. saved by Notepad
+        data = data[3:]
+    for n, line in enumerate(data.splitlines(), 1):
         s = line.strip()
-        if not s or s.startswith("#"):
+        if not s or s[:1] == b"#":
+            continue
+        try:
+            h = s.split(b",", 1)[0].strip().decode("ascii")
+        except UnicodeDecodeError:
+            print(f"{path}:{n}: skipping non-ASCII host entry", file=sys.stderr)
+            continue
+        if h in seen:
             continue
-        hosts.append(s.split(",")[0].strip())
+        seen.add(h)
+        hosts.append(h)
     return hosts
 
-def apply_host(host: str, user: str, pw: str):
+def exec_on_transport(transport, cmd: str) -> str:
+    # extra exec channel on the already-authenticated transport: no new TCP/KEX/auth
+    chan = transport.open_session(timeout=TIMEOUTS["conn_timeout"])
+    try:
+        chan.settimeout(TIMEOUTS["timeout"])
+        chan.exec_command(cmd)
+        out = chan.makefile("rb").read().decode("utf-8", errors="replace")
+        err = chan.makefile_stderr("rb").read().decode("utf-8", errors="replace").strip()
+        status = chan.recv_exit_status()
+        # empty output is only meaningful if the command really ran (root/shell logins, CLI errors)
+        if status != 0 or err:
+            raise RuntimeError(err or f"exec exited with status {status}")
+        return out
+    finally:
+        chan.close()
+
+def verify(conn) -> bool:
+    try:
+        out = exec_on_transport(conn.remote_conn.get_transport(), SHOW_CMD)
+    except (paramiko.SSHException, RuntimeError, OSError):
+        # device refused another channel, the exec failed or timed out; fall back to the CLI session
+        out = conn.send_command(SHOW_CMD, read_timeout=TIMEOUTS["timeout"])
+    have = {" ".join(line.split()) for line in out.splitlines()}
+    return NEED_SET.issubset(have)
+
+def configure_if_missing(host: str, user: str, pw: str):
+    # check -> push/commit only if missing -> re-verify, all on one SSH transport:
+    # checks run on their own exec channels, config on Netmiko's shell channel
+    # returns (host, reachable, present_before, committed, verified, error)
     conn = None
     try:
         log(host, "connecting…")
         conn = ConnectHandler(device_type="juniper", host=host, username=user, password=pw,
-                              fast_cli=False, global_delay_factor=1, **TIMEOUTS)
+                              fast_cli=True, **TIMEOUTS)
         log(host, "connected")
-        try:
-            conn.send_command("set cli screen-length 0")
-        except Exception:
-            pass
 
-        log(host, "entering config mode")
-        conn.config_mode()
+        if verify(conn):
+            log(host, "DONE ✓ (already present)")
+            return (host, True, True, False, True, "")
 
         log(host, "pushing config")
         conn.send_config_set([CMD1, CMD2], exit_config_mode=False)
 
         log(host, "committing")
-        commit = conn.send_command_timing("commit")
+        commit = conn.commit(and_quit=True, read_timeout=TIMEOUTS["timeout"])
         ok = "commit complete" in commit.lower()
 
-        try:
-            conn.exit_config_mode()
-        except Exception:
-            pass
-
-        log(host, "disconnecting")
-        conn.disconnect()
+        log(host, "verifying")
+        verified = verify(conn)
 
-        log(host, "DONE ✓" if ok else "DONE ✗ (commit not confirmed)")
-        return (host, ok, "" if ok else "commit not confirmed")
+        err = "" if verified else ("commit not confirmed" if not ok else "config not present after commit")
+        log(host, "DONE ✓" if verified else f"DONE ✗ ({err})")
+        return (host, True, False, ok, verified, err)
     except Exception as e:
         log(host, f"ERROR: {e}")
-        return (host, False, str(e))
+        return (host, conn is not None, False, False, False, str(e))
     finally:
         try:
             if conn:
@@ -73,26 +127,30 @@ def apply_host(host: str, user: str, pw: str):
 
 def main():
     hosts = load_hosts(DEVICES_FILE)
+    workers = cap_workers(WORKERS)
     with print_lock:
-        print(f"Applying to {len(hosts)} devices with {WORKERS} workers…", flush=True)
+        if workers < WORKERS:
+            print(f"Limiting workers to {workers} (open file limit); raise 'ulimit -n' for more.", flush=True)
+        print(f"Applying to {len(hosts)} devices with {workers} workers…", flush=True)
     user = input("Username: ").strip()
     pw = getpass.getpass("Password: ")
 
     results = []
-    with ThreadPoolExecutor(max_workers=max(1, WORKERS)) as ex:
-        futs = [ex.submit(apply_host, h, user, pw) for h in hosts]
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="junos") as ex:
+        futs = [ex.submit(configure_if_missing, h, user, pw) for h in hosts]
         for f in as_completed(futs):
             results.append(f.result())
 
     total = len(results)
-    ok = sum(1 for _, s, _ in results if s)
-    fails = [h for h, s, _ in results if not s]
+    already = sum(1 for r in results if r[2])
+    committed = sum(1 for r in results if r[3])
+    fails = [r[0] for r in results if not r[4]]
     with print_lock:
-        print(f"\nSummary: total={total} success={ok} failed={total-ok}", flush=True)
+        print(f"\nSummary: total={total} already={already} committed={committed} "
+              f"verified={total-len(fails)} failed={len(fails)}", flush=True)
         if fails:
-            print("Failed hosts:")
-            for h in sorted(fails):
-                print(f"  - {h}")
+            sys.stdout.write("Failed hosts:\n" + "".join(f"  - {h}\n" for h in sorted(fails)))
+            sys.stdout.flush()
 
 if __name__ == "__main__":
     main()